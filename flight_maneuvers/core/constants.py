@@ -14,8 +14,12 @@ NUM_DATALOADERS = 8
 SAMPLING_PERIOD = 60
 # maximum length of a trajectory
 MAX_TIMESTEPS = 256
-# use Automatic Mixed Precision
+# use Automatic Mixed Precision (bf16 autocast, requires compute capability >= 8.0)
 AMP = False
+# compile the model and loss with torch.compile
+COMPILE = False
+# torch.compile mode, 'default' since batches vary in length ('reduce-overhead' captures a CUDA graph per shape)
+COMPILE_MODE = 'default'
 # compute loss with Cross Entropy
 LOSS = torch.nn.functional.cross_entropy
 # number of trajectories used to train the model
@@ -32,8 +36,16 @@ MAX_EPOCHS = 1000
 GRAD_CLIP = 1.0
 # wait this many batches before stepping the optimizer
 GRAD_ACCUM = 1
+# size of the gradient buckets all-reduced by DistributedTrainer, in megabytes
+DDP_BUCKET_CAP_MB = 25
+# log the training loss every this many steps
+LOG_INTERVAL = 10
+# directory holding the tensorboard logs and checkpoints of every run
+LOG_DIR = 'runs'
 # checkpoint every this many epochs
 CKPT_INTERVAL = 1
+# number of most recent checkpoints kept on disk
+CKPT_KEEP = 3
 # validate every this many epochs
 VALID_INTERVAL = 1
 # validate every this many epochs
@@ -57,6 +69,8 @@ default_hparams = {
 	'SAMPLING_PERIOD': SAMPLING_PERIOD,
 	'MAX_TIMESTEPS': MAX_TIMESTEPS,
 	'AMP': AMP,
+	'COMPILE': COMPILE,
+	'COMPILE_MODE': COMPILE_MODE,
 	'LOSS': LOSS,
 	'TRAIN_SIZE': TRAIN_SIZE,
 	'VAL_SIZE': VAL_SIZE,
@@ -65,7 +79,11 @@ default_hparams = {
 	'MAX_EPOCHS': MAX_EPOCHS,
 	'GRAD_CLIP': GRAD_CLIP,
 	'GRAD_ACCUM': GRAD_ACCUM,
+	'DDP_BUCKET_CAP_MB': DDP_BUCKET_CAP_MB,
+	'LOG_INTERVAL': LOG_INTERVAL,
+	'LOG_DIR': LOG_DIR,
 	'CKPT_INTERVAL': CKPT_INTERVAL,
+	'CKPT_KEEP': CKPT_KEEP,
 	'VALID_INTERVAL': VALID_INTERVAL,
 	'TEST_INTERVAL': TEST_INTERVAL,
 	'OPTIMIZER': OPTIMIZER,
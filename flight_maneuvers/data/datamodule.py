@@ -4,20 +4,24 @@ import random
 import numpy as np
 import pandas as pd
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
 
 from flight_maneuvers.data.preprocessing import *
 
 MANEUVERS = ['takeoff', 'turn', 'line', 'orbit', 'landing']
 
-def transfer_to_accelerator(segs):
-    states = []
-    maneuvers = []
-    for seg in segs:
-        states.append(torch.from_numpy(seg[0]).device)
-        maneuvers.append(torch.from_numpy(seg[1]))
-    
-    #states = torch.nested.nested_tensor(states)
-    #maneuvers = torch.nested.nested_tensor(maneuvers)
+# maneuver label assigned to the padded timesteps of a batch, ignored by `torch.nn.functional.cross_entropy`
+PAD_MANEUVER = -100
+
+def collate_trajectories(segs):
+    """ pads a list of (states, maneuvers) trajectories to the length of the longest one
+
+    Returns:
+        states with shape (batch, timesteps, features) and maneuvers with shape (batch, timesteps),
+        where padded timesteps are labeled with `PAD_MANEUVER`
+    """
+    states = pad_sequence([seg[0] for seg in segs], batch_first=True)
+    maneuvers = pad_sequence([seg[1] for seg in segs], batch_first=True, padding_value=PAD_MANEUVER)
     return states, maneuvers
 
 # each training example consists of a variable-length, simulated flight trajectory with labeled maneuvers at each timestep
@@ -42,6 +46,20 @@ class FlightTrajectoryDataset(Dataset):
         maneuvers = maneuvers.map(MANEUVERS.index).to_numpy(dtype='int64')
         return states, maneuvers
 
+# preprocessing reads and resamples a csv per example, so it is done once rather than every epoch
+class PreprocessedFlightDataset(Dataset):
+
+    def __init__(self, dataset) -> None:
+        self.files = dataset.files
+        self.examples = [
+            # copied, since pandas returns read-only arrays
+            (torch.tensor(states), torch.tensor(maneuvers)) for states, maneuvers in dataset
+        ]
+
+    def __len__(self):  return len(self.examples)
+
+    def __getitem__(self, scenario_idx):  return self.examples[scenario_idx]
+
 class FlightTrajectoryDataModule:
     
     def __init__(self, **kwargs) -> None:
@@ -58,35 +76,34 @@ class FlightTrajectoryDataModule:
         assert len(files) >= num_train + num_valid + num_test
         splits = np.cumsum([num_train, num_valid, num_test])
         files = [f for f in np.split(random.sample(files, len(files)), splits)][:-1]
-        self.train_set = FlightTrajectoryDataset([os.path.join(kwargs['TRAIN_DATA_DIR'], f) for f in files[0]], kwargs['SAMPLING_PERIOD'], kwargs['MAX_TIMESTEPS'])
-        self.val_set = FlightTrajectoryDataset([os.path.join(kwargs['TRAIN_DATA_DIR'], f) for f in files[1]], kwargs['SAMPLING_PERIOD'], kwargs['MAX_TIMESTEPS'])
-        self.test_set = FlightTrajectoryDataset([os.path.join(kwargs['TRAIN_DATA_DIR'], f) for f in files[2]], kwargs['SAMPLING_PERIOD'], kwargs['MAX_TIMESTEPS'])
+        self.train_set = PreprocessedFlightDataset(FlightTrajectoryDataset([os.path.join(kwargs['TRAIN_DATA_DIR'], f) for f in files[0]], kwargs['SAMPLING_PERIOD'], kwargs['MAX_TIMESTEPS']))
+        self.val_set = PreprocessedFlightDataset(FlightTrajectoryDataset([os.path.join(kwargs['TRAIN_DATA_DIR'], f) for f in files[1]], kwargs['SAMPLING_PERIOD'], kwargs['MAX_TIMESTEPS']))
+        self.test_set = PreprocessedFlightDataset(FlightTrajectoryDataset([os.path.join(kwargs['TRAIN_DATA_DIR'], f) for f in files[2]], kwargs['SAMPLING_PERIOD'], kwargs['MAX_TIMESTEPS']))
 
-    def train_dataloader(self):
-        return DataLoader(
-            self.train_set, 
-            self.batch_size, 
-            num_workers=self.num_dataloaders, 
-            collate_fn=transfer_to_accelerator, 
-            drop_last=True
-        )
+    def train_dataloader(self, sampler=None):
+        return self.dataloader('train', self.train_set, sampler, drop_last=True)
 
-    def val_dataloader(self):
-        return DataLoader(
-            self.val_set, 
-            self.batch_size, 
-            num_workers=self.num_dataloaders, 
-            collate_fn=transfer_to_accelerator,
-        )
+    def val_dataloader(self, sampler=None):
+        return self.dataloader('val', self.val_set, sampler)
+
+    def test_dataloader(self, sampler=None):
+        return self.dataloader('test', self.test_set, sampler)
 
-    def test_dataloader(self):
+    def dataloader(self, split, dataset, sampler, drop_last=False):
+        # the caller keeps the dataloader for a whole run, so its persistent workers start once per run
+        # and shut down with it
         return DataLoader(
-            self.test_set, 
+            dataset, 
             self.batch_size, 
+            sampler=sampler, 
             num_workers=self.num_dataloaders, 
-            collate_fn=transfer_to_accelerator
+            collate_fn=collate_trajectories, 
+            pin_memory=torch.cuda.is_available(), 
+            persistent_workers=self.num_dataloaders > 0, 
+            prefetch_factor=4 if self.num_dataloaders > 0 else None, 
+            drop_last=drop_last
         )
-    
+
     def state_dict(self):
         return {
             'SEED': self.seed,
@@ -107,9 +124,9 @@ class FlightTrajectoryDataModule:
             self.sampling_period = state['SAMPLING_PERIOD']
             self.num_dataloaders = state['NUM_DATALOADERS']
             self.max_timesteps = state['MAX_TIMESTEPS']
-            self.train_set = FlightTrajectoryDataset(state['train_set'], state['sampling_period'], state['max_timesteps'])
-            self.val_set = FlightTrajectoryDataset(state['val_set'], state['sampling_period'], state['max_timesteps'])
-            self.test_set = FlightTrajectoryDataset(state['test_set'], state['sampling_period'], state['max_timesteps'])
+            self.train_set = PreprocessedFlightDataset(FlightTrajectoryDataset(state['train_set'], state['sampling_period'], state['max_timesteps']))
+            self.val_set = PreprocessedFlightDataset(FlightTrajectoryDataset(state['val_set'], state['sampling_period'], state['max_timesteps']))
+            self.test_set = PreprocessedFlightDataset(FlightTrajectoryDataset(state['test_set'], state['sampling_period'], state['max_timesteps']))
         
         C = cls
         C.__init__ = new_init(state_dict)
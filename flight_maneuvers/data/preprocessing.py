@@ -25,13 +25,17 @@ def sample_timeseries(trajectory, sampling_period, max_length):
         a pandas dataframe with columns t, x, y, z, vx, vy, vz, maneuver
     """
     # load the trajectory and convert the 't' column to a DatetimeIndex
-    trajectory = pd.read_csv(trajectory)
+    return resample_trajectory(pd.read_csv(trajectory), sampling_period, max_length)
 
+
+def resample_trajectory(trajectory, sampling_period, max_length=None):
+    """ resamples a loaded trajectory like `sample_timeseries`, without trimming it if `max_length` is None
+    """
     # initialize resampled_trajectory with the first row of trajectory
     resampled_trajectory = trajectory.iloc[::sampling_period]
 
     # trim the trajectory to the desired maximum length
-    if len(resampled_trajectory) > max_length:
+    if max_length is not None and len(resampled_trajectory) > max_length:
         resampled_trajectory = resampled_trajectory.iloc[:max_length]
 
     resampled_trajectory = resampled_trajectory.reset_index(drop=True)
@@ -48,17 +52,27 @@ def get_states_maneuvers(raw_signal):
     Returns:
         a pandas dataframe with columns z, vx, xy, vz, dx, dy, dz, dvx, dvy, dvz, maneuver
     """
+    return get_states(raw_signal), raw_signal['maneuver']
+
+def get_states(raw_signal):
+    """ computes the delta of a trajectory, which need not be labeled with maneuvers
+
+    Args:
+        trajectory: a pandas dataframe with columns t, x, y, z, vx, vy, vz
+
+    Returns:
+        a pandas dataframe with columns z, vx, xy, vz, dx, dy, dz, dvx, dvy, dvz
+    """
     trajectory = raw_signal[['z', 'vx', 'vy', 'vz']]
-    trajectory = trajectory.assign(dx=raw_signal['x'].diff())
-    trajectory = trajectory.assign(dy=raw_signal['y'].diff())
-    trajectory = trajectory.assign(dz=raw_signal['z'].diff())
-    trajectory['dx'].iloc[0] = trajectory['dy'].iloc[0] = trajectory['dz'].iloc[0] = 0
-    trajectory = trajectory.assign(dvx=raw_signal['vx'].diff())
-    trajectory = trajectory.assign(dvy=raw_signal['vy'].diff())
-    trajectory = trajectory.assign(dvz=raw_signal['vz'].diff())
-    trajectory['dvx'].iloc[0] = trajectory['dvy'] = trajectory['dvz'] = 0
+    # the first timestep has no predecessor, so its deltas are 0
+    trajectory = trajectory.assign(dx=raw_signal['x'].diff().fillna(0))
+    trajectory = trajectory.assign(dy=raw_signal['y'].diff().fillna(0))
+    trajectory = trajectory.assign(dz=raw_signal['z'].diff().fillna(0))
+    trajectory = trajectory.assign(dvx=raw_signal['vx'].diff().fillna(0))
+    trajectory = trajectory.assign(dvy=raw_signal['vy'].diff().fillna(0))
+    trajectory = trajectory.assign(dvz=raw_signal['vz'].diff().fillna(0))
     # initialize delta_trajectory with the first row of trajectory
-    return trajectory, raw_signal['maneuver']
+    return trajectory
 
 def to_tensors(trajectory, maneuver):
     """ converts a trajectory to a torch tensor
@@ -8,6 +8,43 @@ def pairwise(iterable):
     next(b, None)
     return zip(a, b)
 
+class MaskedBatchNorm1d(nn.BatchNorm1d):
+    """ BatchNorm1d whose batch statistics only cover the unpadded timesteps of a padded batch
+
+    `mask` has shape (batch, 1, timesteps) and is 1 at unpadded timesteps. Padded timesteps are left
+    out of the mean and variance, so the normalization of a trajectory does not depend on how much
+    shorter it is than the others in its batch, and they are zeroed in the output, so the 'same'
+    padding of the next convolution sees zeros past the end of every trajectory.
+    """
+
+    def forward(self, x, mask=None):
+        if mask is None:
+            return super().forward(x)
+        dtype, x = x.dtype, x.float()
+        if self.training:
+            n = mask.sum()
+            mean = (x * mask).sum((0, 2)) / n
+            var = (((x - mean[:, None]) * mask) ** 2).sum((0, 2)) / n
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = 1 / self.num_batches_tracked.item() if self.momentum is None else self.momentum
+                self.running_mean.lerp_(mean.detach(), momentum)
+                self.running_var.lerp_(var.detach() * n / (n - 1), momentum)
+        else:
+            mean, var = self.running_mean, self.running_var
+        x = (x - mean[:, None]) * torch.rsqrt(var[:, None] + self.eps)
+        return ((x * self.weight[:, None] + self.bias[:, None]) * mask).to(dtype)
+
+
+class MaskedSequential(nn.Sequential):
+    """ Sequential that passes the padding mask on to the layers that take one """
+
+    def forward(self, x, mask=None):
+        for module in self:
+            x = module(x, mask) if isinstance(module, masked_module_types) else module(x)
+        return x
+
+
 class ResNetBlock(nn.Module):
 
     def __init__(self, c_in, k_size, act_fn, c_out=-1):
@@ -22,18 +59,18 @@ class ResNetBlock(nn.Module):
         # linear
         self.proj = nn.Conv1d(c_in, c_out, kernel_size=1, padding='same', bias=False)
         # residual
-        self.net = nn.Sequential(
+        self.net = MaskedSequential(
             nn.Conv1d(c_in, c_out, kernel_size=k_size, padding='same', bias=False),  # No bias needed as the Batch Norm handles it
-            nn.BatchNorm1d(c_out),
+            MaskedBatchNorm1d(c_out),
             act_fn(),
             nn.Conv1d(c_out, c_out, kernel_size=k_size, padding='same', bias=False),
-            nn.BatchNorm1d(c_out)
+            MaskedBatchNorm1d(c_out)
         )
 
         self.act_fn = act_fn()
 
-    def forward(self, x):
-        z = self.net(x)
+    def forward(self, x, mask=None):
+        z = self.net(x, mask)
         out = z + self.proj(x)
         return self.act_fn(out)
         
@@ -51,19 +88,21 @@ class PreActResNetBlock(nn.Module):
         self.proj = nn.Conv1d(c_in, c_out, kernel_size=1, padding='same', bias=False)
         self.act_fn = act_fn()
         # Network representing F
-        self.net = nn.Sequential(
-            nn.BatchNorm1d(c_in),
+        self.net = MaskedSequential(
+            MaskedBatchNorm1d(c_in),
             act_fn(),
             nn.Conv1d(c_in, c_out, kernel_size=k_size, padding='same', bias=False),
-            nn.BatchNorm1d(c_out),
+            MaskedBatchNorm1d(c_out),
             act_fn(),
             nn.Conv1d(c_out, c_out, kernel_size=k_size, padding='same', bias=False)
         )
 
-    def forward(self, x):
-        z = self.net(x)
+    def forward(self, x, mask=None):
+        z = self.net(x, mask)
         return z + self.proj(x)
 
+masked_module_types = (MaskedBatchNorm1d, MaskedSequential, ResNetBlock, PreActResNetBlock)
+
 resnet_block_types = {
     "ResNetBlock": ResNetBlock,
     "PreActResNetBlock": PreActResNetBlock
@@ -100,16 +139,16 @@ class ResNet(nn.Module):
         self.act_fn_name = act_fn_name
                 
         # A first convolution on the original image to scale up the channel size
-        self.input_net = nn.Sequential(
+        self.input_net = MaskedSequential(
                 nn.Conv1d(state_dim, c_hidden[0], kernel_size=1, padding="same", bias=False)
-            ) if resnet_block_types[block_name] == PreActResNetBlock else nn.Sequential(
+            ) if resnet_block_types[block_name] == PreActResNetBlock else MaskedSequential(
                 nn.Conv1d(state_dim, c_hidden[0], kernel_size=1, padding="same", bias=False),
-                nn.BatchNorm1d(c_hidden[0]),
+                MaskedBatchNorm1d(c_hidden[0]),
                 act_fn_by_name[act_fn_name]()
             )
         
         # Creating the ResNet blocks
-        self.blocks = nn.Sequential(*[
+        self.blocks = MaskedSequential(*[
             resnet_block_types[block_name](
                 c_in=c_in,
                 act_fn=act_fn_by_name[act_fn_name],
@@ -138,10 +177,19 @@ class ResNet(nn.Module):
                 nn.init.constant_(m.bias, 0) # set beta to 0
                                
 
-    def forward(self, x):
-        x = torch.transpose(x, -1, -2).unsqueeze(0).contiguous()        
-        x = self.input_net(x)
-        x = self.blocks(x).transpose(-1, -2).squeeze(0)
+    def forward(self, x, mask=None):
+        # x is a single trajectory (timesteps, features) or a padded batch (batch, timesteps, features)
+        # mask (batch, timesteps) is True at the unpadded timesteps of a padded batch
+        unbatched = x.dim() == 2
+        x = torch.transpose(x, -1, -2)
+        if unbatched:
+            x = x.unsqueeze(0)
+        if mask is not None:
+            mask = mask.unsqueeze(1).to(x.dtype)
+        x = self.input_net(x.contiguous(), mask)
+        x = self.blocks(x, mask).transpose(-1, -2)
+        if unbatched:
+            x = x.squeeze(0)
         x = self.output_net(x)
         return x
     
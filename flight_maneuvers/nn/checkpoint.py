@@ -5,52 +5,99 @@
 import os
 import json
 import torch
-import torch
 
-def load_checkpoint(**hparams):
-    """Load a model checkpoint and return the iteration.
-    strict (bool): whether to strictly enforce that the keys in
-        :attr:`state_dict` of the checkpoint match the names of
-        parameters and buffers in model.
+from flight_maneuvers.nn.optim import configure_optimizer, configure_scheduler
+
+CKPT_PREFIX = 'epoch='
+CKPT_SUFFIX = '.pt'
+VERSION_PREFIX = 'version'
+VERSION_SEP = ' - '
+
+def load_checkpoint(model, device='cpu', **hparams):
+    """Load the latest checkpoint of the run configured by `hparams` into `model`.
+
+    Returns the model, moved to `device`, its optimizer, scheduler, and the loaded checkpoint, which also
+    holds the epoch and best validation loss to resume from; if the run has no checkpoint yet, the model
+    keeps its weights, the optimizer and scheduler are freshly created, and the checkpoint is empty.
+    """
+    # the optimizer state is loaded onto the device of the parameters, so they are moved first
+    model.to(device)
+    optimizer = configure_optimizer(model.parameters(), **hparams)
+    scheduler = configure_scheduler(optimizer, **hparams)
+    checkpoint = {}
+    ckpt_path = get_latest_checkpoint(get_hparam_logdir(**hparams))
+    if ckpt_path is not None:
+        # if a checkpoint exists, resume the model, optimizer, and scheduler from it
+        checkpoint = torch.load(ckpt_path, map_location=device)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if 'scheduler' in checkpoint:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+    return model, optimizer, scheduler, checkpoint
+
+def save_model_checkpoint(to_save, epoch, hparams):
+    """Save the state returned by `Trainer.state_dict`, keeping only the `CKPT_KEEP` most recent checkpoints on disk."""
+    version = get_hparam_logdir(create=True, **hparams)
+    torch.save(to_save, os.path.join(version, CKPT_PREFIX + str(epoch) + CKPT_SUFFIX))
+    prune_checkpoints(version, hparams.get('CKPT_KEEP', 3))
+
+def scan_checkpoints(version_path):
+    """Yield (epoch, path) for every checkpoint in `version_path` in a single directory scan."""
+    if not os.path.isdir(version_path):
+        return
+    with os.scandir(version_path) as entries:
+        for entry in entries:
+            epoch = entry.name[len(CKPT_PREFIX):-len(CKPT_SUFFIX)]
+            if entry.name.startswith(CKPT_PREFIX) and entry.name.endswith(CKPT_SUFFIX) and epoch.isdigit():
+                yield int(epoch), entry.path
+
+def get_latest_checkpoint(version_path):
+    """Return the path of the checkpoint with the highest epoch, or None if there is none.
+
+    Epochs are compared as integers, since 'epoch=10.pt' sorts before 'epoch=9.pt' as a string.
+    """
+    latest_epoch, latest_path = -1, None
+    for epoch, path in scan_checkpoints(version_path):
+        if epoch > latest_epoch:
+            latest_epoch, latest_path = epoch, path
+    return latest_path
+
+def prune_checkpoints(version_path, keep):
+    """Remove all but the `keep` most recent checkpoints in `version_path`."""
+    checkpoints = sorted(scan_checkpoints(version_path))
+    for _, path in checkpoints[:max(len(checkpoints) - keep, 0)]:
+        os.remove(path)
+
+def hparams_to_json(hparams):
+    """Return `hparams` as plain JSON data, with classes and functions replaced by their qualified names."""
+    return json.loads(json.dumps(hparams, sort_keys=True, default=lambda value: getattr(value, '__qualname__', repr(value))))
+
+def get_hparam_logdir(create=False, **hparams):
+    """Return the version directory of the run configured by `hparams`.
+
+    Each run of a model lives in 'runs/<model>/version - <n>' next to the hparams.json it was trained
+    with, so the same hparams always map to the same directory. If no run matches, the next free version
+    is returned, and created with its hparams.json when `create` is set.
     """
-    version = get_version_logs(model_type, hparams)
-    
-    model_type = hparams['MODEL']
-    optimizer_type = hparams['OPTIMIZER']
-    scheduler_type = hparams['SCHEDULER']
-
-    version_path = os.path.join('runs', model_type.__qualname__, ' - ', version)
-    ckpt_path = os.path.join(version_path, 'checkpoint.pt')
-    if os.path.exists(ckpt_path):
-        # if a checkpoint exists, load the model, optimizer, and datamodule
-        model_state = torch.load(os.path.join(ckpt_path, 'model.pt'))
-        optimizer_state = torch.load(os.path.join(ckpt_path, 'optimizer.pt'))
-        model = model_type.load_state_dict(model_state),
-        optimizer = optimizer_type.load_state_dict(optimizer_state),
-        return model, optimizer, scheduler
-
-    else:
-        # if no checkpoint exists, create a new model, optimizer, and datamodule
-        model = model_type(**hparams)
-        optimizer = optimizer_type(model.parameters(), **hparams)
-        scheduler = scheduler_type(optimizer, **hparams)
-        return model, optimizer, scheduler
-
-def save_model_checkpoint(model, datamodule, optimizer, hparams):
-    """Save a model checkpoint."""
-    to_save = { 'model': model.state_dict(), 'datamodule': datamodule.state_dict(), 'optimizer': optimizer.state_dict() }
-    version = get_hparam_logdir(model, hparams)
-    torch.save(to_save, os.path.join(version, 'model.pt'))
-
-def get_hparam_logdir(**hparams):
-    # create a directory for the model type
-    version_number = 0
-    model_path = os.path.join('runs', hparams['MODEL'].__qualname__)
-    os.makedirs(model_path, exist_ok=True)
-    for path in os.listdir(model_path):
-        # get version number from the rightmost string of digits
-        version_number = int(path.split(' - ')[-1])
-        if json.load(os.path.join(model_path, path)) == json.loads(hparams):
-            return os.path.join(model_path, ' - ', path)
-    return os.path.join(model_path, ' - ', str(version_number + 1))        
-    
+    model_path = os.path.join(hparams.get('LOG_DIR', 'runs'), hparams['MODEL'].__qualname__)
+    config = hparams_to_json(hparams)
+    version_number = -1
+    if os.path.isdir(model_path):
+        with os.scandir(model_path) as entries:
+            for entry in entries:
+                # get version number from the rightmost string of digits
+                prefix, _, number = entry.name.rpartition(VERSION_SEP)
+                if prefix != VERSION_PREFIX or not number.isdigit():
+                    continue
+                version_number = max(version_number, int(number))
+                hparams_path = os.path.join(entry.path, 'hparams.json')
+                if os.path.isfile(hparams_path):
+                    with open(hparams_path) as f:
+                        if json.load(f) == config:
+                            return entry.path
+    version_path = os.path.join(model_path, VERSION_PREFIX + VERSION_SEP + str(version_number + 1))
+    if create:
+        os.makedirs(version_path)
+        with open(os.path.join(version_path, 'hparams.json'), 'w') as f:
+            json.dump(config, f, indent=4)
+    return version_path
@@ -20,8 +20,15 @@ tb_layout = {
 }
 
 class TensorboardLogger(SummaryWriter):
-    def __init__(self, log_dir='runs'):
-        super().__init__(log_dir)
+    # events are buffered and written to disk in batches rather than on every call to `add_scalar`
+    def __init__(self, log_dir='runs', max_queue=1000, flush_secs=30):
+        super().__init__(log_dir, max_queue=max_queue, flush_secs=flush_secs)
+
+
+class NullLogger():
+    """ accepts and discards every logging call, for processes that should not write logs """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
 
 
     
@@ -0,0 +1,43 @@
+""" builds the optimizer and learning rate scheduler selected by the hyperparameters """
+
+import torch
+
+# keyword arguments of each supported optimizer, besides the learning rate
+OPTIMIZER_KWARGS = {
+    torch.optim.Adam: lambda hparams: {},
+    torch.optim.AdamW: lambda hparams: {'weight_decay': hparams['WEIGHT_DECAY']},
+    torch.optim.SGD: lambda hparams: {'momentum': hparams['MOMENTUM'], 'weight_decay': hparams['WEIGHT_DECAY'], 'nesterov': True},
+}
+
+# optimizers with a fused implementation that applies the whole update in a single kernel
+FUSED_OPTIMIZERS = {torch.optim.Adam, torch.optim.AdamW}
+
+# keyword arguments of each supported learning rate scheduler
+SCHEDULER_KWARGS = {
+    torch.optim.lr_scheduler.ReduceLROnPlateau: lambda hparams: {'mode': 'min'},
+    torch.optim.lr_scheduler.CosineAnnealingLR: lambda hparams: {'T_max': hparams['MAX_EPOCHS']},
+}
+
+def configure_optimizer(params, **hparams):
+    """ constructs the optimizer `hparams['OPTIMIZER']` over `params`
+
+    The trainer places the model on the GPU whenever one is available, so the fused kernel is used
+    then, and the multi-tensor (foreach) implementation otherwise; both replace a kernel launch per
+    parameter with one launch per step.
+    """
+    optimizer_type = hparams['OPTIMIZER']
+    if optimizer_type not in OPTIMIZER_KWARGS:
+        raise ValueError('optimizer ' + optimizer_type.__name__ + ' is unknown!')
+    kwargs = OPTIMIZER_KWARGS[optimizer_type](hparams)
+    if optimizer_type in FUSED_OPTIMIZERS and torch.cuda.is_available():
+        kwargs['fused'] = True
+    else:
+        kwargs['foreach'] = True
+    return optimizer_type(params, lr=hparams['LR'], **kwargs)
+
+def configure_scheduler(optimizer, **hparams):
+    """ constructs the learning rate scheduler `hparams['LR_SCHEDULER']` for `optimizer` """
+    scheduler_type = hparams['LR_SCHEDULER']
+    if scheduler_type not in SCHEDULER_KWARGS:
+        raise ValueError('scheduler ' + scheduler_type.__name__ + ' is unknown!')
+    return scheduler_type(optimizer, **SCHEDULER_KWARGS[scheduler_type](hparams))
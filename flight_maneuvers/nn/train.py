@@ -1,14 +1,22 @@
+import os
 import torch
+from contextlib import nullcontext
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
 from abc import ABC, abstractmethod
-from statistics import mean, stdev
 
-from flight_maneuvers.nn.checkpoint import load_checkpoint
-from flight_maneuvers.nn.log import TensorboardLogger, StandardOutLogger
+from flight_maneuvers.data.datamodule import PAD_MANEUVER
+from flight_maneuvers.data.preprocessing import get_states, resample_trajectory
+from flight_maneuvers.data.postprocessing import postprocess_joint
+from flight_maneuvers.nn.checkpoint import load_checkpoint, save_model_checkpoint
+from flight_maneuvers.nn.log import TensorboardLogger, StandardOutLogger, NullLogger
 
 class BaseTrainer(ABC):
      
     @abstractmethod
-    def state_dict(self, model_type, **hparams):
+    def state_dict(self):
         pass
 
     @abstractmethod
@@ -28,93 +36,436 @@ class BatchTrainer(BaseTrainer):
         self.optimizers = [optimizer(model.parameters(), **hparams) for model, optimizer in zip(models, optimizers)]
         self.schedulers = [scheduler(optimizer, **hparams) for optimizer in optimizers]
 
-class DistributedTrainer(BaseTrainer):
-    pass
-
 class Trainer(BaseTrainer):
     def __init__(self, model, datamodule, **hparams):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.console_logger = StandardOutLogger()
-        self.tensorboard_logger = TensorboardLogger()
+        # only one process writes logs when training is distributed
+        self.tensorboard_logger = TensorboardLogger(hparams.get('LOG_DIR', 'runs')) if self.is_global_zero else NullLogger()
+        # the run, and with it the checkpoints resumed by `fit`, is identified by the class of `model`
+        self.hparams = dict(hparams, MODEL=type(model))
+        self.data_module = datamodule
+        self.model = model
+        self.loss_fn = hparams['LOSS']
+        # bf16 shares the exponent range of fp32, so no GradScaler is needed
+        self.use_amp = hparams.get('AMP', False) and torch.cuda.is_available() \
+            and torch.cuda.get_device_capability() >= (8, 0)
+        # AOTInductor packages loaded by `predict_aot`, by path
+        self.aot_models = {}
         
+    def state_dict(self):
+        """ the model, datamodule, optimizer, and scheduler state written to a checkpoint, with the
+        epoch and best validation loss a resumed `fit` continues from
+        """
+        return {
+            'model': self.unwrapped_model.state_dict(),
+            'datamodule': self.data_module.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'epoch': self.epoch,
+            'best_val_loss': self.best_val_loss,
+        }
+
     @classmethod
     def load_state_dict(cls):
         T = cls()
         def __init__(self, model_type, **hparams):
             pass
 
-    def fit(self, model_type, early_stopping, max_steps=None, **hparams):
-            
-            # Loads the most recent checkpoint from indicated version of `model_type`, or creates 
-            # a new model if no version is specified 
-            self.model, self.optimizer, self.scheduler = load_checkpoint(model_type, **hparams)        
-            self.model.to(self.device)
+    def fit(self, early_stopping=None, max_steps=None, **hparams):
+            """ trains the model for up to `MAX_EPOCHS` epochs, then returns the test loss and accuracy
+
+            Args:
+                early_stopping: an `EarlyStopping` stepped with the validation loss of each epoch
+                max_steps: if given, training stops after this many optimizer steps, even mid-epoch
+                hparams: override the hparams the trainer was created with
+            """
+            self.hparams = dict(self.hparams, **hparams)
+            self.loss_fn = self.hparams['LOSS']
 
-            # Loads the most recent checkpoint from indicated version of `model_type`, or creates
-            train_loader = self.data_module.train_dataloader()
-            val_loader = self.data_module.val_dataloader()
-            best_val_loss = float('inf')
+            # Loads the most recent checkpoint of the run configured by the hparams into the model,
+            # which keeps its weights if the run has no checkpoint yet
+            self.model, self.optimizer, self.scheduler, checkpoint = load_checkpoint(self.unwrapped_model, self.device, **self.hparams)
+            assert self.scheduler is not None, 'load_checkpoint returned no learning rate scheduler'
+            # allow TF32 for the matmuls left in fp32
+            torch.set_float32_matmul_precision('high')
+            # compiled before wrapping, so `eval_model` is compiled as well
+            if self.hparams.get('COMPILE', False):
+                self.compile()
+            self.model = self.setup_model(self.model)
+            # the scheduler type is fixed for the run, so it is inspected once rather than every epoch
+            self.plateau_scheduler = isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau)
 
-            for epoch in range(self.hparams['MAX_EPOCHS']):
+            train_loader = self.data_module.train_dataloader(sampler=self.sampler(self.data_module.train_set))
+            val_loader = self.data_module.val_dataloader(sampler=self.eval_sampler(self.data_module.val_set))
+            # a resumed run continues numbering its epochs, so its checkpoints rotate out the older ones
+            start_epoch = checkpoint.get('epoch', -1) + 1
+            self.best_val_loss = checkpoint.get('best_val_loss', float('inf'))
+            log_interval = self.hparams.get('LOG_INTERVAL', 10)
+            grad_accum = self.hparams.get('GRAD_ACCUM', 1)
+            self.global_step = 0
+            self.optimizer_steps = 0
+            self.optimizer.zero_grad()
+            # looked up once rather than on every batch
+            eval_step, eval_model, optimizer, no_sync = self.eval_step, self.eval_model, self.optimizer, self.no_sync
+
+            # pay the compilation cost before the first epoch so it is not measured
+            if self.hparams.get('COMPILE', False):
+                self.warmup(train_loader, val_loader)
+
+            for epoch in range(start_epoch, self.hparams['MAX_EPOCHS']):
+                if max_steps is not None and self.optimizer_steps >= max_steps:
+                    break
+                self.epoch = epoch
                 
                 # Train
+                self.model.train()
                 loss_list = []
                 accuracy_list = []
-                for idx, batch in train_loader:
-                    self.optimizer.zero_grad()
-                    loss, accuracy = self.eval_step(self.model, train_loader, logger=self.log)
-                    loss.backward()        
-                    self.optimizer.step()
+                timesteps_list = []
+                num_batches = len(train_loader)
+                for batch_idx, batch in enumerate(train_loader):
+                    # the optimizer steps once every `GRAD_ACCUM` batches and after the last batch of the
+                    # epoch, so no accumulated gradient is carried over validation into the next epoch
+                    cycle_start = batch_idx - batch_idx % grad_accum
+                    cycle_size = min(grad_accum, num_batches - cycle_start)
+                    accumulating = batch_idx + 1 < cycle_start + cycle_size
+                    with no_sync(accumulating):
+                        loss, accuracy, timesteps = eval_step(batch)
+                        # average the gradients of the batches that make up one optimizer step
+                        (loss / cycle_size).backward()
+                    if not accumulating:
+                        optimizer.step()
+                        optimizer.zero_grad()
+                        self.optimizer_steps += 1
                     
-                    self.tensorboard_logger.add_scalar('Loss/train', loss.item(), idx)
-                    self.tensorboard_logger.add_scalar('Accuracy/train', accuracy.item().mean(), idx)
-                    loss_list.append(loss.item())
-                    accuracy_list.append(accuracy.item())
+                    # reading the loss back forces a device sync, so it is only done every few steps
+                    if self.global_step % log_interval == 0:
+                        self.tensorboard_logger.add_scalar('Loss/train', loss.item(), self.global_step)
+                    # accuracy is derived from argmax, so autograd never tracks it and only the loss needs detaching
+                    loss_list.append(loss.detach())
+                    accuracy_list.append(accuracy)
+                    timesteps_list.append(timesteps)
+                    self.global_step += 1
+                    if max_steps is not None and self.optimizer_steps >= max_steps:
+                        break
                 
+                loss_mean, _ = self.summarize(loss_list, timesteps_list)
+                accuracy_mean, _ = self.summarize(accuracy_list, timesteps_list)
+                self.tensorboard_logger.add_scalar('Loss/train/mean', loss_mean, epoch)
+                self.tensorboard_logger.add_scalar('Accuracy/train', accuracy_mean, epoch)
                 
                 # Validate
+                self.model.eval()
                 loss_list = []
                 accuracy_list = []
-                for idx, batch in val_loader:                 
-                    loss, accuracy = self.eval_step(self.model, val_loader, logger=self.log)
-                    loss_list.append(loss.item())
-                    accuracy_list.append(accuracy.item())
+                timesteps_list = []
+                # inference mode also skips the version counter and view tracking of no_grad
+                with torch.inference_mode():
+                    for batch in val_loader:
+                        loss, accuracy, timesteps = eval_step(batch, eval_model)
+                        loss_list.append(loss)
+                        accuracy_list.append(accuracy)
+                        timesteps_list.append(timesteps)
                 
-                self.tensorboard_logger.add_scalar('Loss/val/mean', mean(loss_list), idx)
-                self.tensorboard_logger.add_scalar('Loss/val/stdev', stdev(loss_list), idx)
-                self.tensorboard_logger.add_scalar('Accuracy/val/mean', mean(accuracy_list), idx)
-                self.tensorboard_logger.add_scalar('Accuracy/val/stdev', stdev(accuracy_list), idx)
-                if self.scheduler is torch.optim.lr_scheduler.ReduceLROnPlateau:
-                    self.scheduler_step(sum(loss_list)/len(loss))
+                # every rank gets the loss over the whole validation set, so the schedulers stay in sync
+                val_loss, val_loss_stdev = self.summarize(loss_list, timesteps_list)
+                accuracy_mean, accuracy_stdev = self.summarize(accuracy_list, timesteps_list)
+                self.tensorboard_logger.add_scalar('Loss/val/mean', val_loss, epoch)
+                self.tensorboard_logger.add_scalar('Loss/val/stdev', val_loss_stdev, epoch)
+                self.tensorboard_logger.add_scalar('Accuracy/val/mean', accuracy_mean, epoch)
+                self.tensorboard_logger.add_scalar('Accuracy/val/stdev', accuracy_stdev, epoch)
+                # events are buffered, so they are written out once per epoch
+                self.tensorboard_logger.flush()
+                if self.plateau_scheduler:
+                    self.scheduler.step(val_loss)
+                else:
+                    self.scheduler.step()
 
 
                 # Checkpoint Model that minimizes validation error
-                if best_val_loss > mean(loss_list):
-                    best_val_loss = mean(loss_list)
-                    self.save_checkpoint(self.model, self.optimizer, epoch, self.log, best_val_loss)
+                if epoch % self.hparams.get('CKPT_INTERVAL', 1) == 0 and self.best_val_loss > val_loss:
+                    self.best_val_loss = val_loss
+                    # the ranks hold identical replicas, so only one of them writes the checkpoint
+                    if self.is_global_zero:
+                        save_model_checkpoint(self.state_dict(), epoch, self.hparams)
                 
-                # Early stopping
-                if early_stopping == False:
-                    break
+                # Early stopping, skipped entirely when no `EarlyStopping` is given
+                if early_stopping is not None:
+                    early_stopping.step(val_loss)
+                    if not early_stopping.keep_going:
+                        break
 
 
             # Test the model
             loss_list = []
             accuracy_list = []
-            test_loader = self.data_module.test_dataloader()
-            for idx, batch in test_loader:
-                loss, accuracy = self.eval_step(self.model, test_loader, logger=self.log)
-                loss_list.append(loss.item())
-                accuracy_list.append(accuracy.item())
+            timesteps_list = []
+            test_loader = self.data_module.test_dataloader(sampler=self.eval_sampler(self.data_module.test_set))
+            self.model.eval()
+            with torch.inference_mode():
+                for batch in test_loader:
+                    loss, accuracy, timesteps = eval_step(batch, eval_model)
+                    loss_list.append(loss)
+                    accuracy_list.append(accuracy)
+                    timesteps_list.append(timesteps)
                 
-            return sum(loss_list)/len(loss), sum(accuracy_list)/len(accuracy)
+            loss_mean, _ = self.summarize(loss_list, timesteps_list)
+            accuracy_mean, _ = self.summarize(accuracy_list, timesteps_list)
+            # writes the remaining events, a later `fit` reopens the event file
+            self.tensorboard_logger.close()
+            return loss_mean, accuracy_mean
+
+
+    @property
+    def is_global_zero(self):
+            return not dist.is_initialized() or dist.get_rank() == 0
+
+    @property
+    def eval_model(self):
+            """ the model without the wrapper added by `setup_model`
+
+            Evaluation needs no gradient synchronization, and ranks may evaluate different numbers of
+            batches, which would deadlock the buffer broadcast DistributedDataParallel runs every forward.
+            """
+            return getattr(self.model, 'module', self.model)
+
+    @property
+    def unwrapped_model(self):
+            """ the model without the wrappers added by `setup_model` and `compile`, as loaded by `load_checkpoint` """
+            return getattr(self.eval_model, '_orig_mod', self.eval_model)
+
+    def setup_model(self, model):
+            """ wraps the model for the training strategy; a single device needs no wrapper """
+            return model
+
+    def sampler(self, dataset):
+            """ returns the sampler used to draw from `dataset`, or None for sequential sampling """
+            return None
+
+    def eval_sampler(self, dataset):
+            """ like `sampler`, for the validation and test sets, which must be drawn exactly once """
+            return None
+
+    def sum_across_processes(self, tensor):
+            """ sums `tensor` over the training processes; a single process has nothing to sum """
+            return tensor
+
+    def summarize(self, values, weights):
+            """ returns the weighted mean and standard deviation of per-batch metrics over all processes
+
+            Metrics are accumulated as device tensors during an epoch and copied to the host once here,
+            instead of synchronizing with `.item()` after every batch. Each batch is weighted by the number of
+            timesteps it contributes, so shorter trailing batches do not count as much as full ones; the
+            standard deviation is that of the weighted population, which is 0 for a single batch. Only the
+            weighted sums are reduced across processes, so every rank returns the statistics of all batches.
+            """
+            totals = torch.zeros(3, dtype=torch.float64, device=self.device)
+            if values:
+                values = torch.stack(values).double()
+                weights = torch.stack(weights).double()
+                totals = torch.stack([(values * weights).sum(), (values ** 2 * weights).sum(), weights.sum()])
+            totals = self.sum_across_processes(totals)
+            mean = totals[0] / totals[2]
+            std = (totals[1] / totals[2] - mean ** 2).clamp(min=0).sqrt()
+            return tuple(torch.stack([mean, std]).tolist())
+
+    def no_sync(self, accumulating):
+            """ context in which the backward pass of a batch that does not step the optimizer runs """
+            return nullcontext()
+
+    def compile(self):
+            """ compiles the model and loss with `torch.compile`
+
+            Fuses pointwise kernels (activations, residual adds, the softmax inside the loss). Batches are
+            padded to their longest trajectory, so shapes vary and `COMPILE_MODE` defaults to 'default':
+            'reduce-overhead' records a CUDA graph per shape and only pays off for fixed-shape batches.
+            """
+            mode = self.hparams.get('COMPILE_MODE', 'default')
+            # the uncompiled originals are wrapped, so compiling again in a later `fit` does not nest wrappers
+            self.model = torch.compile(self.unwrapped_model, mode=mode)
+            self.loss_fn = torch.compile(self.hparams['LOSS'], mode=mode)
+            self.joint_distribution = torch.compile(type(self).joint_distribution.__get__(self), mode=mode)
+
+    def warmup(self, train_loader, val_loader):
+            """ runs a training and a validation batch through the compiled model to trigger compilation
+
+            The training batch runs the forward and backward pass without stepping the optimizer, and the
+            batch norm statistics both batches update are restored, so warming up leaves the model untouched.
+            """
+            buffers = [buffer.clone() for buffer in self.model.buffers()]
+            self.model.train()
+            loss, _, _ = self.eval_step(next(iter(train_loader)))
+            loss.backward()
+            self.optimizer.zero_grad()
+            self.model.eval()
+            with torch.inference_mode():
+                self.eval_step(next(iter(val_loader)), self.eval_model)
+            with torch.no_grad():
+                for buffer, saved in zip(self.model.buffers(), buffers):
+                    buffer.copy_(saved)
+
+    def joint_distribution(self, x):
+            """ probability of each maneuver at every timestep of `x` """
+            # the same precision as training, autocast runs the softmax itself in fp32
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+                return self.eval_model(x).softmax(-1)
+
+    @torch.inference_mode()
+    def predict(self, trajectory):
+            """ predicts the maneuver flown at each timestep of `trajectory`
 
+            With `COMPILE`, the forward pass and softmax run as one compiled graph; the first call pays
+            the compilation cost, so latency-sensitive callers should predict once on a representative
+            trajectory at startup.
 
-    def eval_step(self, batch):
+            Args:
+                trajectory: a pandas dataframe with columns t, x, y, z, vx, vy, vz, sampled like the training
+                    data and not resampled yet; a maneuver column is not needed
+
+            Returns:
+                a pandas dataframe with the probability of each maneuver and the predicted maneuver at every
+                `SAMPLING_PERIOD`-th timestep, the resolution the model is trained at
+            """
+            x = self.states(trajectory)
+            training = self.model.training
+            self.model.eval()
+            joint_dist = self.joint_distribution(x)
+            self.model.train(training)
+            return postprocess_joint(joint_dist.float().cpu().numpy())
+
+    def export(self, path, trajectory):
+            """ compiles the model ahead of time into an AOTInductor package at `path`
+
+            Unlike `torch.compile`, the package is compiled once and loaded by later processes without
+            tracing, so `predict_aot` neither pays a compilation cost at startup nor recompiles when the
+            trajectory length changes: the number of timesteps is exported as a dynamic dimension. The
+            package runs under the same bf16 autocast as `predict` when `AMP` is on.
+
+            Args:
+                path: where the package is written, conventionally ending in '.pt2'
+                trajectory: an example trajectory, in the format accepted by `predict`
+            """
+            model = self.unwrapped_model
+            training = model.training
+            model.eval()
+            timesteps = torch.export.Dim('timesteps', min=2)
+            program = torch.export.export(
+                JointDistribution(model, self.device.type, self.use_amp),
+                (self.states(trajectory),),
+                dynamic_shapes=({0: timesteps},),
+            )
+            model.train(training)
+            return torch._inductor.aoti_compile_and_package(program, package_path=path)
+
+    @torch.inference_mode()
+    def predict_aot(self, path, trajectory):
+            """ predicts like `predict`, with the model package written to `path` by `export` """
+            if path not in self.aot_models:
+                self.aot_models[path] = torch._inductor.aoti_load_package(path)
+            joint_dist = self.aot_models[path](self.states(trajectory))
+            return postprocess_joint(joint_dist.float().cpu().numpy())
+
+    def states(self, trajectory):
+            """ converts a trajectory dataframe to the (timesteps, features) tensor fed to the model
+
+            The trajectory is resampled like the training data, so the deltas span the same time, but not trimmed
+            to `MAX_TIMESTEPS`.
+            """
+            states = get_states(resample_trajectory(trajectory, self.hparams['SAMPLING_PERIOD']))
+            return torch.tensor(states.to_numpy(dtype='float32'), device=self.device)
+
+    def eval_step(self, batch, model=None):
+            """ returns the loss, accuracy, and number of unpadded timesteps of `batch` under `model`, by default the trained one """
+            model = self.model if model is None else model
             inputs, targets = batch
-            logits = self.model(inputs)
-            loss = self.hparams['LOSS'](logits, targets)
-            accuracy = (logits.argmax(dim=-1) == targets).float()
-            return loss, accuracy
+            # batches come from pinned memory, so the copies overlap with the previous step
+            inputs = inputs.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
+            mask = targets != PAD_MANEUVER
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+                # the mask keeps the padded timesteps out of the batch norm statistics
+                logits = model(inputs, mask)
+                # mean over the unpadded timesteps of the batch, so no further normalization is needed
+                loss = self.loss_fn(logits.flatten(0, 1), targets.flatten())
+            timesteps = mask.sum()
+            accuracy = ((logits.argmax(dim=-1) == targets) & mask).sum() / timesteps
+            return loss, accuracy, timesteps
 
     # If the selected scheduler is a ReduceLROnPlateau scheduler.
+
+
+class JointDistribution(torch.nn.Module):
+    """ the joint distribution computed by `Trainer.joint_distribution`, as a module `torch.export` can trace
+
+    Autocast entered inside `forward` is recorded in the exported graph, unlike autocast around the export.
+    """
+    def __init__(self, model, device_type, use_amp):
+        super().__init__()
+        self.model = model
+        self.device_type = device_type
+        self.use_amp = use_amp
+
+    def forward(self, x):
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16, enabled=self.use_amp):
+            return self.model(x).softmax(-1)
+
+
+class DistributedTrainer(Trainer):
+    """ trains one process per GPU with DistributedDataParallel
+
+    Launch with `torchrun --nproc_per_node=<number of GPUs>`. Unlike DataParallel, there is no master
+    GPU and no GIL contention: each rank holds a replica of the model, trains on a disjoint shard of the
+    dataset, and gradients are all-reduced in buckets of `DDP_BUCKET_CAP_MB` while the backward pass is
+    still running. `gradient_as_bucket_view` lets gradients alias the communication buckets, saving a copy.
+    """
+    def __init__(self, model, datamodule, **hparams):
+        if not dist.is_initialized():
+            dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+        super().__init__(model, datamodule, **hparams)
+        self.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        if torch.cuda.is_available():
+            self.device = torch.device('cuda', self.local_rank)
+            torch.cuda.set_device(self.device)
+
+    def setup_model(self, model):
+            return DistributedDataParallel(
+                model,
+                device_ids=[self.local_rank] if self.device.type == 'cuda' else None,
+                gradient_as_bucket_view=True,
+                bucket_cap_mb=self.hparams.get('DDP_BUCKET_CAP_MB', 25),
+            )
+
+    def sum_across_processes(self, tensor):
+            dist.all_reduce(tensor)
+            return tensor
+
+    def no_sync(self, accumulating):
+            # gradients are only all-reduced on the batch that steps the optimizer
+            return self.model.no_sync() if accumulating else nullcontext()
+
+    def sampler(self, dataset):
+            # each rank draws a disjoint slice of the dataset rather than a copy of it
+            return DistributedSampler(dataset, shuffle=False)
+
+    def eval_sampler(self, dataset):
+            # DistributedSampler pads the shards with repeated examples, which would count twice in the metrics
+            return ShardSampler(dataset)
+
+
+class ShardSampler(Sampler):
+    """ draws every `num_replicas`-th example of a dataset, starting at `rank`
+
+    Unlike DistributedSampler, the shards are not padded to the same length with repeated examples, so
+    each example of the dataset is drawn by exactly one rank.
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        rank = dist.get_rank() if rank is None else rank
+        self.indices = range(rank, len(dataset), num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
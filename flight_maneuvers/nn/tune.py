@@ -9,12 +9,20 @@ import torch
 import random
 import numpy as np
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 from flight_maneuvers.nn.train import Trainer
 from flight_maneuvers.data.datamodule import FlightTrajectoryDataModule
 
 NUM_SEEDS = 30
 
+# most datamodules kept by `get_datamodule`, enough for every seed of a trial
+DATA_CACHE_SIZE = NUM_SEEDS
+
+# datamodules already built by `test_error`, keyed by the hyperparameters that determine their contents,
+# from least to most recently used
+_DATA_CACHE = OrderedDict()
+
 def seed_everything(seed):
     seed = int(seed)
     random.seed(seed)
@@ -24,20 +32,21 @@ def seed_everything(seed):
         torch.cuda.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
 
-def tune(model, sampler, target_metric, number_seeds=NUM_SEEDS, max_trials=100):
+def tune(model, sampler, target_metric, number_seeds=NUM_SEEDS, max_trials=100, nsteps=None):
     """ tune the parameters of the model
 
-
+    Trials sample hyperparameters from `sampler` until the expected test accuracy reaches `target_metric`
+    or `max_trials` trials ran, and the hyperparameters with the best expected test accuracy are returned.
     """
     best_hparams = None
     best_metric = metric = 0
     trial_num = 0
     while metric < target_metric and trial_num < max_trials:
-        trial += 1
+        trial_num += 1
         # sample a set of hyperparameters
         hparams = sampler.sample()
         # train the model with the set of hyperparameters
-        metric = expected_test_error(model, hparams, trial)
+        _, metric = expected_test_error(model, hparams, number_seeds, trial_num, nsteps)
         # update the best set of hyperparameters if the metric is better
         if best_metric < metric:
             best_hparams = hparams
@@ -46,11 +55,11 @@ def tune(model, sampler, target_metric, number_seeds=NUM_SEEDS, max_trials=100):
     return best_hparams
 
 
-def expected_test_error(model, hparams, number_seeds, trail_number):
-    """ calculate the expected test error of the model
+def expected_test_error(model, hparams, number_seeds, trail_number, nsteps=None):
+    """ calculate the expected test error of the model, returns the test loss and accuracy averaged over `number_seeds` seeds
     """
-    for seed in range(number_seeds):
-        test_error(model, hparams, seed, trail_number)
+    errors = [test_error(model, hparams, nsteps, seed, trail_number) for seed in range(number_seeds)]
+    return tuple(np.mean(errors, axis=0).tolist())
 
 def test_error(model, hparams, nsteps, seed, trail_number):
     """ calculate the test error of the model for a model trained with a test set produced by seed
@@ -58,16 +67,37 @@ def test_error(model, hparams, nsteps, seed, trail_number):
     Err_T = E[L(y, f(x)) | T]
 
     where L is the loss function, f is the model trained on fixed training set T,
-    and y and x are drawn randomly from some distribution P(y, x)
+    and y and x are drawn randomly from some distribution P(y, x). Training stops after `nsteps`
+    optimizer steps, if given; the test loss and accuracy are returned.
     """
     # set the seed
     seed_everything(seed)
-    datamodule = FlightTrajectoryDataModule(**hparams)
-    model = model(**hparams)
-    trainer = Trainer(model, datamodule, **hparams)
-    trainer.fit()
+    # the seed is part of the run, so a run never resumes from a checkpoint trained on another split
+    hparams = dict(hparams, SEED=seed)
+    datamodule = get_datamodule(seed, **hparams)
+    trainer = Trainer(model(**hparams), datamodule, **hparams)
+    return trainer.fit(max_steps=nsteps)
+
 
 
+def get_datamodule(seed, **hparams):
+    """ returns the datamodule split by `seed`, building it only the first time it is requested
+
+    Every trial of `tune` trains on the same seeds, so trials after the first reuse the preprocessed
+    datasets of the earlier ones. At most `DATA_CACHE_SIZE` datamodules are kept, the least recently
+    used is evicted first. The global random state must already be seeded with `seed`, which determines
+    the split.
+    """
+    key = (seed, hparams.get('TRAIN_DATA_DIR'), hparams['TRAIN_SIZE'], hparams['VAL_SIZE'], hparams['TEST_SIZE'],
+           hparams['SAMPLING_PERIOD'], hparams['MAX_TIMESTEPS'], hparams['BATCH_SIZE'], hparams['NUM_DATALOADERS'])
+    if key in _DATA_CACHE:
+        _DATA_CACHE.move_to_end(key)
+        return _DATA_CACHE[key]
+    if len(_DATA_CACHE) >= DATA_CACHE_SIZE:
+        _DATA_CACHE.popitem(last=False)
+    _DATA_CACHE[key] = FlightTrajectoryDataModule(**hparams)
+    return _DATA_CACHE[key]
+
 
 class BaseModelSampler(ABC):
     @abstractmethod
@@ -1,6 +1,8 @@
 import unittest
 from unittest import TestCase
 
+import torch
+
 from flight_maneuvers.models.gnn.resnet import ResNet
 from flight_maneuvers.data.datamodule import MANEUVERS, FlightTrajectoryDataModule
 
@@ -33,6 +35,36 @@ class TestResnet(TestCase):
             out = model.forward(x)
             self.assertEqual(out.shape, (x.shape[0], model_params["num_maneuvers"]))
 
+    def test_resnet_padded_batch(self):
+        torch.manual_seed(0)
+        lengths = [12, 7]
+        trajectories = [torch.randn(n, 10) for n in lengths]
+        for block_name in ["ResNetBlock", "PreActResNetBlock"]:
+            model = ResNet(c_hidden=[16, 32, 64], kernel_size=[3, 3], block_name=block_name)
+            padded_model = ResNet(c_hidden=[16, 32, 64], kernel_size=[3, 3], block_name=block_name)
+            padded_model.load_state_dict(model.state_dict())
+            # the same trajectories padded to different lengths produce the same outputs and statistics
+            outputs = []
+            for m, timesteps in [(model, 12), (padded_model, 20)]:
+                x = torch.zeros(2, timesteps, 10)
+                mask = torch.zeros(2, timesteps, dtype=torch.bool)
+                for i, trajectory in enumerate(trajectories):
+                    x[i, :len(trajectory)] = trajectory
+                    mask[i, :len(trajectory)] = True
+                out = m(x, mask)
+                self.assertEqual(out.shape, (2, timesteps, 5))
+                outputs.append(out)
+            for i, n in enumerate(lengths):
+                self.assertTrue(torch.allclose(outputs[0][i, :n], outputs[1][i, :n], atol=1e-5))
+            for buffer, padded_buffer in zip(model.buffers(), padded_model.buffers()):
+                self.assertTrue(torch.allclose(buffer.float(), padded_buffer.float(), atol=1e-5))
+            # in eval mode a trajectory of the batch is predicted as if it were alone
+            model.eval()
+            x = torch.zeros(2, 12, 10)
+            x[0], x[1, :7] = trajectories
+            out = model(x, torch.arange(12) < torch.tensor(lengths)[:, None])
+            self.assertTrue(torch.allclose(out[1, :7], model(trajectories[1]), atol=1e-5))
+
     def test_train_resnet(self):
         model = train(ResNet, {
             "state_dim": 12,
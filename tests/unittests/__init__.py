@@ -0,0 +1,16 @@
+import os
+import numpy as np
+import pandas as pd
+
+from flight_maneuvers.data.datamodule import MANEUVERS
+
+
+def write_trajectories(data_dir, num_trajectories, min_timesteps=20, max_timesteps=60, seed=0):
+    # writes `num_trajectories` random flight trajectories of varying length to `data_dir` as csv files
+    rng = np.random.default_rng(seed)
+    for i in range(num_trajectories):
+        timesteps = rng.integers(min_timesteps, max_timesteps)
+        trajectory = pd.DataFrame(rng.normal(size=(timesteps, 6)), columns=['x', 'y', 'z', 'vx', 'vy', 'vz'])
+        trajectory.insert(0, 't', np.arange(timesteps))
+        trajectory['maneuver'] = rng.choice(MANEUVERS, timesteps)
+        trajectory.to_csv(os.path.join(data_dir, 'trajectory_{}.csv'.format(i)), index=False)
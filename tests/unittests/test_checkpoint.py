@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+
+import torch
+
+from flight_maneuvers.core.constants import default_hparams
+from flight_maneuvers.models.gnn.resnet import ResNet
+from flight_maneuvers.nn.checkpoint import get_hparam_logdir, get_latest_checkpoint, load_checkpoint, prune_checkpoints, save_model_checkpoint
+
+class TestCheckpoint(TestCase):
+
+    def make_checkpoints(self, dir, epochs):
+        for epoch in epochs:
+            open(os.path.join(dir, 'epoch={}.pt'.format(epoch)), 'w').close()
+
+    def test_latest_checkpoint(self):
+        with tempfile.TemporaryDirectory() as dir:
+            self.assertIsNone(get_latest_checkpoint(dir))
+            self.make_checkpoints(dir, [1, 9, 10])
+            open(os.path.join(dir, 'hparams.json'), 'w').close()
+            self.assertEqual(get_latest_checkpoint(dir), os.path.join(dir, 'epoch=10.pt'))
+
+    def test_prune_checkpoints(self):
+        with tempfile.TemporaryDirectory() as dir:
+            self.make_checkpoints(dir, range(12))
+            prune_checkpoints(dir, keep=3)
+            self.assertEqual(sorted(os.listdir(dir)), ['epoch=10.pt', 'epoch=11.pt', 'epoch=9.pt'])
+
+    def test_save_and_load_checkpoint(self):
+        with tempfile.TemporaryDirectory() as dir:
+            hparams = dict(default_hparams, LOG_DIR=dir, CKPT_KEEP=3, c_hidden=[4, 8], kernel_size=[3])
+            model, optimizer, _, checkpoint = load_checkpoint(ResNet(**hparams), **hparams)
+            self.assertEqual(checkpoint, {})
+            for epoch in range(5):
+                with torch.no_grad():
+                    model.output_net[-1].bias.fill_(epoch)
+                save_model_checkpoint({'model': model.state_dict(), 'optimizer': optimizer.state_dict()}, epoch, hparams)
+            # every save lands in the same version directory, which only keeps the newest checkpoints
+            version_path = get_hparam_logdir(**hparams)
+            self.assertEqual(os.listdir(os.path.join(dir, 'ResNet')), [os.path.basename(version_path)])
+            self.assertEqual(sorted(os.listdir(version_path)), ['epoch=2.pt', 'epoch=3.pt', 'epoch=4.pt', 'hparams.json'])
+            model, _, _, _ = load_checkpoint(ResNet(**hparams), **hparams)
+            self.assertTrue(torch.equal(model.output_net[-1].bias, torch.full_like(model.output_net[-1].bias, 4)))
+            # different hparams start a new version without any checkpoint
+            model, _, _, _ = load_checkpoint(ResNet(**hparams), **dict(hparams, LR=1e-2))
+            self.assertNotEqual(get_hparam_logdir(**dict(hparams, LR=1e-2)), version_path)
+            self.assertFalse(torch.equal(model.output_net[-1].bias, torch.full_like(model.output_net[-1].bias, 4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1 +1,53 @@
-# TODO
\ No newline at end of file
+import os
+import random
+import tempfile
+import unittest
+from unittest import TestCase
+
+import torch
+
+from flight_maneuvers.core.constants import default_hparams
+from flight_maneuvers.data.datamodule import PAD_MANEUVER, FlightTrajectoryDataModule, FlightTrajectoryDataset, PreprocessedFlightDataset, collate_trajectories
+from tests.unittests import write_trajectories
+
+class TestDatamodule(TestCase):
+
+    def test_collate_trajectories(self):
+        segs = [(torch.ones(3, 10), torch.tensor([0, 1, 2])), (torch.ones(5, 10), torch.tensor([4, 3, 2, 1, 0]))]
+        states, maneuvers = collate_trajectories(segs)
+        self.assertEqual(states.shape, (2, 5, 10))
+        self.assertEqual(maneuvers.tolist(), [[0, 1, 2, PAD_MANEUVER, PAD_MANEUVER], [4, 3, 2, 1, 0]])
+        self.assertTrue(torch.equal(states[0, 3:], torch.zeros(2, 10)))
+
+    def test_preprocessed_dataset(self):
+        with tempfile.TemporaryDirectory() as dir:
+            write_trajectories(dir, 4)
+            dataset = FlightTrajectoryDataset([os.path.join(dir, f) for f in os.listdir(dir)], 2, 16)
+            preprocessed = PreprocessedFlightDataset(dataset)
+            self.assertEqual(preprocessed.files, dataset.files)
+            self.assertEqual(len(preprocessed), len(dataset))
+            for (states, maneuvers), (expected_states, expected_maneuvers) in zip(preprocessed, dataset):
+                self.assertEqual(states.shape, (min(len(maneuvers), 16), 10))
+                self.assertTrue(torch.equal(states, torch.tensor(expected_states)))
+                self.assertTrue(torch.equal(maneuvers, torch.tensor(expected_maneuvers)))
+                # the deltas of the first timestep are 0 rather than NaN
+                self.assertFalse(states.isnan().any())
+                self.assertTrue(torch.equal(states[0, 4:], torch.zeros(6)))
+
+    def test_dataloaders(self):
+        with tempfile.TemporaryDirectory() as dir:
+            write_trajectories(dir, 12)
+            random.seed(0)
+            hparams = dict(default_hparams, TRAIN_DATA_DIR=dir, TRAIN_SIZE=6, VAL_SIZE=3, TEST_SIZE=3, BATCH_SIZE=4,
+                           SAMPLING_PERIOD=2, MAX_TIMESTEPS=16, NUM_DATALOADERS=0)
+            datamodule = FlightTrajectoryDataModule(**hparams)
+            # the last partial training batch is dropped, the evaluation batches are kept whole
+            self.assertEqual(len(datamodule.train_dataloader()), 1)
+            self.assertEqual(len(datamodule.val_dataloader()), 1)
+            states, maneuvers = next(iter(datamodule.train_dataloader()))
+            self.assertEqual(states.shape[:2], maneuvers.shape)
+            self.assertLessEqual(states.shape[1], 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from unittest import TestCase
+
+import torch
+
+from flight_maneuvers.core.constants import default_hparams
+from flight_maneuvers.nn.optim import configure_optimizer, configure_scheduler
+
+class TestOptim(TestCase):
+
+    def test_configure_optimizer(self):
+        model = torch.nn.Linear(10, 5)
+        for optimizer_type in [torch.optim.Adam, torch.optim.AdamW, torch.optim.SGD]:
+            hparams = dict(default_hparams, OPTIMIZER=optimizer_type)
+            optimizer = configure_optimizer(model.parameters(), **hparams)
+            self.assertIsInstance(optimizer, optimizer_type)
+            self.assertEqual(optimizer.defaults['lr'], hparams['LR'])
+
+    def test_configure_scheduler(self):
+        optimizer = configure_optimizer(torch.nn.Linear(10, 5).parameters(), **default_hparams)
+        scheduler = configure_scheduler(optimizer, **default_hparams)
+        self.assertIsInstance(scheduler, default_hparams['LR_SCHEDULER'])
+
+    def test_unknown_optimizer(self):
+        hparams = dict(default_hparams, OPTIMIZER=torch.optim.Adagrad)
+        with self.assertRaises(ValueError):
+            configure_optimizer(torch.nn.Linear(10, 5).parameters(), **hparams)
+
+
+if __name__ == '__main__':
+    unittest.main()
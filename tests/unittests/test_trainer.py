@@ -0,0 +1,144 @@
+import os
+import math
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+
+import torch
+import pandas as pd
+from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+
+from flight_maneuvers.core.constants import default_hparams
+from flight_maneuvers.data.datamodule import MANEUVERS, FlightTrajectoryDataModule, FlightTrajectoryDataset
+from flight_maneuvers.models.gnn.resnet import ResNet
+from flight_maneuvers.nn.checkpoint import get_hparam_logdir, get_latest_checkpoint
+from flight_maneuvers.nn.train import ShardSampler, Trainer
+from tests.unittests import write_trajectories
+
+class TestTrainer(TestCase):
+
+    def make_trainer(self, dir, **hparams):
+        data_dir = os.path.join(dir, 'data')
+        os.makedirs(data_dir)
+        write_trajectories(data_dir, 12)
+        random.seed(0)
+        hparams = dict(dict(default_hparams, TRAIN_DATA_DIR=data_dir, LOG_DIR=os.path.join(dir, 'runs'),
+                            TRAIN_SIZE=6, VAL_SIZE=3, TEST_SIZE=3, BATCH_SIZE=2, SAMPLING_PERIOD=2, MAX_TIMESTEPS=16,
+                            NUM_DATALOADERS=0, MAX_EPOCHS=2, c_hidden=[8, 16], kernel_size=[3]), **hparams)
+        return Trainer(ResNet(**hparams), FlightTrajectoryDataModule(**hparams), **hparams), hparams
+
+    def test_summarize(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, _ = self.make_trainer(dir)
+            # batches are weighted by their timesteps, and a single batch has no spread
+            self.assertEqual(trainer.summarize([torch.tensor(2.)], [torch.tensor(5)]), (2., 0.))
+            mean, std = trainer.summarize([torch.tensor(1.), torch.tensor(3.)], [torch.tensor(1), torch.tensor(3)])
+            self.assertAlmostEqual(mean, 2.5)
+            self.assertAlmostEqual(std, 0.75 ** 0.5)
+            # the weighted sums of the ranks are combined, so a rank without batches still gets the global mean
+            trainer.sum_across_processes = lambda totals: totals + torch.tensor([3., 9., 1.], dtype=totals.dtype)
+            self.assertEqual(trainer.summarize([], []), (3., 0.))
+            mean, std = trainer.summarize([torch.tensor(1.)], [torch.tensor(1)])
+            self.assertAlmostEqual(mean, 2.)
+            self.assertAlmostEqual(std, 1.)
+
+    def test_shard_sampler(self):
+        # the shards cover every example exactly once, without padding
+        shards = [list(ShardSampler(range(7), num_replicas=3, rank=rank)) for rank in range(3)]
+        self.assertEqual(shards, [[0, 3, 6], [1, 4], [2, 5]])
+        self.assertEqual([len(ShardSampler(range(7), num_replicas=3, rank=rank)) for rank in range(3)], [3, 2, 2])
+
+    def test_fit(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, hparams = self.make_trainer(dir)
+            loss, accuracy = trainer.fit()
+            # the logger is closed, so the logged scalars are on disk once fit returns
+            self.assertIsNone(trainer.tensorboard_logger.file_writer)
+            events = EventAccumulator(os.path.join(dir, 'runs'))
+            events.Reload()
+            self.assertEqual(len(events.Scalars('Loss/val/mean')), 2)
+            self.assertTrue(math.isfinite(loss))
+            self.assertTrue(0 <= accuracy <= 1)
+            self.assertEqual(trainer.global_step, 2 * 3)
+            self.assertEqual(trainer.optimizer_steps, 2 * 3)
+            # checkpoints are written under LOG_DIR and hold the state of the bare model
+            version_path = get_hparam_logdir(**hparams)
+            self.assertTrue(version_path.startswith(os.path.join(dir, 'runs')))
+            checkpoint = torch.load(get_latest_checkpoint(version_path))
+            ResNet(**hparams).load_state_dict(checkpoint['model'])
+
+    def test_fit_resumes(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, hparams = self.make_trainer(dir, CKPT_KEEP=2, MAX_EPOCHS=4)
+            # interrupted after the first epoch of 3 batches
+            trainer.fit(max_steps=3)
+            self.assertEqual(trainer.epoch, 0)
+            version_path = get_hparam_logdir(**hparams)
+            first = torch.load(get_latest_checkpoint(version_path))
+            # the next fit of the same run continues after the epoch of its latest checkpoint
+            trainer.fit()
+            self.assertEqual(trainer.global_step, 3 * 3)
+            latest = torch.load(get_latest_checkpoint(version_path))
+            self.assertGreaterEqual(latest['epoch'], first['epoch'])
+            self.assertLessEqual(latest['best_val_loss'], first['best_val_loss'])
+            self.assertEqual(latest['scheduler'].keys(), trainer.scheduler.state_dict().keys())
+
+    def test_fit_given_model(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, _ = self.make_trainer(dir)
+            model = trainer.model
+            trainer.fit(max_steps=1)
+            self.assertIs(trainer.unwrapped_model, model)
+            # compiling again wraps the originals rather than the compiled wrappers
+            trainer.compile()
+            trainer.compile()
+            self.assertIs(trainer.model._orig_mod, model)
+
+    def test_predict(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, hparams = self.make_trainer(dir, MAX_TIMESTEPS=100)
+            path = trainer.data_module.test_set.files[0]
+            trajectory = pd.read_csv(path)
+            prediction = trainer.predict(trajectory.drop(columns='maneuver'))
+            # the unlabeled trajectory is preprocessed like the training data
+            states, _ = FlightTrajectoryDataset([path], hparams['SAMPLING_PERIOD'], hparams['MAX_TIMESTEPS'])[0]
+            self.assertEqual(len(prediction), len(states))
+            self.assertEqual(len(prediction), math.ceil(len(trajectory) / hparams['SAMPLING_PERIOD']))
+            trainer.model.eval()
+            with torch.no_grad():
+                expected = trainer.model(torch.tensor(states)).softmax(-1)
+            self.assertTrue(torch.allclose(torch.tensor(prediction[MANEUVERS].to_numpy()), expected, atol=1e-6))
+            self.assertEqual(prediction['maneuver'].tolist(), [MANEUVERS[i] for i in expected.argmax(-1)])
+
+    @unittest.skipUnless(hasattr(torch._inductor, 'aoti_compile_and_package') and shutil.which(os.environ.get('CXX', 'c++')),
+                         'AOTInductor is unavailable')
+    def test_predict_aot(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, hparams = self.make_trainer(dir, MAX_TIMESTEPS=100)
+            example, trajectory = [pd.read_csv(path).drop(columns='maneuver') for path in trainer.data_module.test_set.files[:2]]
+            self.assertNotEqual(len(trainer.states(example)), len(trainer.states(trajectory)))
+            # the trajectory length is dynamic, and the package runs under the same autocast as predict
+            for use_amp, atol in [(False, 1e-5), (True, 1e-2)]:
+                trainer.use_amp = use_amp
+                path = os.path.join(dir, 'model_amp={}.pt2'.format(use_amp))
+                trainer.export(path, example)
+                expected = trainer.predict(trajectory)
+                prediction = trainer.predict_aot(path, trajectory)
+                self.assertTrue(torch.allclose(torch.tensor(prediction[MANEUVERS].to_numpy()), torch.tensor(expected[MANEUVERS].to_numpy()), atol=atol))
+                with torch.inference_mode():
+                    states = trainer.states(trajectory)
+                    self.assertEqual(trainer.aot_models[path](states).dtype, trainer.joint_distribution(states).dtype)
+
+    def test_fit_max_steps(self):
+        with tempfile.TemporaryDirectory() as dir:
+            trainer, _ = self.make_trainer(dir, GRAD_ACCUM=2)
+            trainer.fit(max_steps=3)
+            # each epoch of 3 batches steps after its second and, with a partial cycle, its last batch
+            self.assertEqual(trainer.optimizer_steps, 3)
+            self.assertEqual(trainer.global_step, 3 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
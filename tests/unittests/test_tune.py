@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from flight_maneuvers.core.constants import default_hparams
+from flight_maneuvers.models.gnn.resnet import ResNet
+from flight_maneuvers.nn import tune
+from flight_maneuvers.nn.tune import BaseModelSampler, get_datamodule, seed_everything
+from tests.unittests import write_trajectories
+
+class FixedSampler(BaseModelSampler):
+
+    def __init__(self, hparams):
+        self.hparams = hparams
+
+    def sample(self):
+        return self.hparams
+
+class TestTune(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        data_dir = os.path.join(self.dir.name, 'data')
+        os.makedirs(data_dir)
+        write_trajectories(data_dir, 12)
+        self.hparams = dict(default_hparams, TRAIN_DATA_DIR=data_dir, LOG_DIR=os.path.join(self.dir.name, 'runs'),
+                            TRAIN_SIZE=6, VAL_SIZE=3, TEST_SIZE=3, BATCH_SIZE=2, SAMPLING_PERIOD=2, MAX_TIMESTEPS=16,
+                            NUM_DATALOADERS=0, MAX_EPOCHS=1, c_hidden=[8, 16], kernel_size=[3])
+        cache = mock.patch.object(tune, '_DATA_CACHE', type(tune._DATA_CACHE)())
+        cache.start()
+        self.addCleanup(cache.stop)
+
+    def datamodule(self, seed, **hparams):
+        seed_everything(seed)
+        return get_datamodule(seed, **dict(self.hparams, **hparams))
+
+    def test_get_datamodule(self):
+        with mock.patch.object(tune, 'DATA_CACHE_SIZE', 2):
+            first, second = self.datamodule(0), self.datamodule(1)
+            # a hit returns the cached datamodule and marks it as the most recently used
+            self.assertIs(self.datamodule(0), first)
+            self.assertIsNot(self.datamodule(0, BATCH_SIZE=3), first)
+            # the least recently used datamodule was evicted
+            self.assertEqual(len(tune._DATA_CACHE), 2)
+            self.assertIs(self.datamodule(0), first)
+            self.assertIsNot(self.datamodule(1), second)
+
+    def test_tune(self):
+        with mock.patch.object(tune, 'FlightTrajectoryDataModule', wraps=tune.FlightTrajectoryDataModule) as datamodule:
+            hparams = tune.tune(ResNet, FixedSampler(self.hparams), target_metric=1.1, number_seeds=2, max_trials=2, nsteps=1)
+        self.assertIs(hparams, self.hparams)
+        # every seed is its own run, and the second trial reused the datamodules of the first
+        self.assertEqual(len(os.listdir(os.path.join(self.dir.name, 'runs', 'ResNet'))), 2)
+        self.assertEqual(datamodule.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()